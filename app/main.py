@@ -1,20 +1,23 @@
 import asyncio
-import hashlib
-import json
 import logging
-import pickle
-from copy import deepcopy
-from datetime import datetime, timedelta, timezone
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from time import sleep
-from typing import Any, Dict, List, Optional
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from fastapi import BackgroundTasks, FastAPI
+import orjson
+from blake3 import blake3
+from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, JSONResponse
 from kentik_api import ImageType, KentikAPI
 from kentik_api.api_connection.retryable_session import RetryableSession
 from kentik_api.public.errors import KentikAPIError, TimedOutError
+from kentik_api.public.query_object import QueryChartResult
 from pydantic import BaseModel, BaseSettings
 
 from object_cache import *
@@ -34,6 +37,7 @@ class Settings(BaseSettings):
     kentik_api_url: str = "https://api.kentik.com/api/v5"
     kentik_api_retries: int = 3
     kentik_api_timeout: int = 60  # seconds
+    kentik_api_concurrency: int = 64  # max concurrent requests
     entry_wait_timeout: int = kentik_api_retries * kentik_api_timeout + 5  # seconds
     default_ttl: int = 300  # seconds
     cache_path: str = "cache"
@@ -84,11 +88,25 @@ class CacheInfo(BaseModel):
     pending_entries: List[CacheEntryInfo]
 
 
+def expiration_ts(image_id: str) -> Optional[float]:
+    """
+    Parse expiration time (in seconds since epoch) from image id
+    Ids with hash part that is not alphanumeric (e.g. containing path separators) are not valid.
+    """
+
+    h, sep, ts = image_id.rpartition("_")
+    if not sep or not h.isalnum():
+        return None
+    try:
+        return float(ts)
+    except ValueError:
+        return None
+
+
 # Create object cache
-cache = ObjectCache(Path(settings.cache_path).resolve(), entry_wait_timeout=settings.entry_wait_timeout)
+cache = ObjectCache(Path(settings.cache_path).resolve(), expiration=expiration_ts)
 # Create Kentik API client
-retry_strategy = deepcopy(RetryableSession.DEFAULT_RETRY_STRATEGY)
-retry_strategy.total = settings.kentik_api_retries
+retry_strategy = RetryableSession.DEFAULT_RETRY_STRATEGY.new(total=settings.kentik_api_retries)
 api = KentikAPI(
     settings.kt_auth_email,
     settings.kt_auth_token,
@@ -96,26 +114,73 @@ api = KentikAPI(
     retry_strategy=retry_strategy,
     timeout=float(settings.kentik_api_timeout),
 )
+# Executor for blocking Kentik API calls, sized independently of the default executor
+api_executor = ThreadPoolExecutor(max_workers=settings.kentik_api_concurrency, thread_name_prefix="kentik_api")
 
 app = FastAPI()
 
+# Events signalling activation of pending entries, keyed by image id.
+# Only accessed from the event loop thread, so no locking is needed
+_waiters: Dict[str, asyncio.Event] = dict()
+
+
+# Requests with larger body (in bytes) have the image ID computed in the default executor
+_LARGE_QUERY_SIZE = 64 * 1024
+
+
+def make_image_id(api_query: Any, ttl: int) -> Tuple[str, bytes]:
+    """
+    Construct unique image ID based on query data and expiration time.
+    Returns the ID together with the serialized query data, which was used for hashing
+    """
+
+    payload = orjson.dumps(jsonable_encoder(api_query), option=orjson.OPT_SORT_KEYS)
+    h = blake3(payload).hexdigest(16)
+    return f"{h}_{time() + ttl}", payload
+
+
+# Image type tags used in serialized image entries. Tags are persisted in the cache, so new types must be appended.
+_IMG_TAGS = (ImageType.png, ImageType.jpg, ImageType.svg, ImageType.pdf)
+# Image entry data: 1 byte image type tag + 4 bytes big-endian image data length.
+# Image data itself is stored as the entry's blob.
+_IMG_INFO = struct.Struct(">BI")
+# MIME types of images returned by Kentik API
+_IMG_MIME = {
+    ImageType.png.value: "image/png",
+    ImageType.pdf.value: "application/pdf",
+    ImageType.jpg.value: "image/jpeg",
+    ImageType.svg.value: "image/svg",
+}
 
-def make_image_id(api_query: Dict, ttl: int) -> str:
+
+def pack_image_info(r: QueryChartResult) -> bytes:
     """
-    Construct unique image ID based on query data and expiration time
+    Serialize image type tag and image data length of chart image
     """
 
-    h = hashlib.sha256(str(api_query).encode()).hexdigest()
-    t = datetime.now(timezone.utc) + timedelta(seconds=ttl)
-    return f"{h}_{t.timestamp()}"
+    return _IMG_INFO.pack(_IMG_TAGS.index(r.image_type), len(r.image_data))
 
 
-def fetch_image(image_id: str, query: Dict) -> None:
+def unpack_image_info(data: Union[bytes, memoryview]) -> Optional[Tuple[ImageType, int]]:
     """
-    Execute 'topxchart' Kentik API query and store resulting image (or error code and message) in the cache
+    Return image type and image data length from data serialized by pack_image_info
+    Return None if data are not in that format (e.g. image entries stored by older versions)
+    """
+
+    if len(data) != _IMG_INFO.size:
+        return None
+    tag, size = _IMG_INFO.unpack(data)
+    if tag >= len(_IMG_TAGS):
+        return None
+    return _IMG_TAGS[tag], size
+
+
+def store_image(image_id: str, query: Dict) -> None:
+    """
+    Execute 'topxchart' Kentik API query and store resulting image (or error code and message) in the cache.
+    Both the API call and writing to the cache are blocking, so this runs in the api_executor.
     """
 
-    log.info("fetch_image: %s", image_id)
     try:
         r = api.query.chart(query)
         log.info(
@@ -124,13 +189,13 @@ def fetch_image(image_id: str, query: Dict) -> None:
             r.image_type.name,
             len(r.image_data),
         )
-        cache.activate_entry(image_id, CacheEntryType.IMAGE, pickle.dumps(r))
+        cache.activate_entry(image_id, CacheEntryType.IMAGE, pack_image_info(r), blob=r.image_data)
     except TimedOutError:
         log.error("fetch_image: %s: timeout", image_id)
         cache.activate_entry(
             image_id,
             CacheEntryType.ERROR_MSG,
-            json.dumps(dict(status_code=500, msgs=["Request timeout"])),
+            orjson.dumps(dict(status_code=500, msgs=["Request timeout"])),
         )
     except KentikAPIError as e:
         if hasattr(e, "status_code"):
@@ -143,11 +208,26 @@ def fetch_image(image_id: str, query: Dict) -> None:
             cache.activate_entry(
                 image_id,
                 CacheEntryType.ERROR_MSG,
-                json.dumps(dict(status_code=e.status_code, msgs=e.args)),
+                orjson.dumps(dict(status_code=e.status_code, msgs=e.args)),
             )
         else:
             log.error("fetch_image: %s: API error %s", image_id, e)
-            cache.activate_entry(image_id, CacheEntryType.ERROR_MSG, json.dumps(dict(status_code=504, msgs=str(e))))
+            cache.activate_entry(image_id, CacheEntryType.ERROR_MSG, orjson.dumps(dict(status_code=504, msgs=str(e))))
+
+
+async def fetch_image(image_id: str, query: Dict) -> None:
+    """
+    Fetch image and store it in the cache (see store_image) without blocking the event loop.
+    Tasks waiting for the entry are woken up when done.
+    """
+
+    log.info("fetch_image: %s", image_id)
+    try:
+        await asyncio.get_running_loop().run_in_executor(api_executor, store_image, image_id, query)
+    finally:
+        ev = _waiters.pop(image_id, None)
+        if ev is not None:
+            ev.set()
     log.debug("fetch_image: %s: done", image_id)
 
 
@@ -156,16 +236,7 @@ def img_type_to_media(img_type: ImageType) -> str:
     Convert kentik-api.ImageType to corresponding MIME type
     """
 
-    i2m = {
-        ImageType.png.value: "image/png",
-        ImageType.pdf.value: "application/pdf",
-        ImageType.jpg.value: "image/jpeg",
-        ImageType.svg.value: "image/svg",
-    }
-    if img_type.value not in i2m:
-        return "image/unknown"
-    else:
-        return i2m[img_type.value]
+    return _IMG_MIME.get(img_type.value, "image/unknown")
 
 
 def expiration(image_id: str) -> Optional[datetime]:
@@ -173,36 +244,39 @@ def expiration(image_id: str) -> Optional[datetime]:
     Parse expiration timestamp from image id
     """
 
-    # noinspection PyBroadException
-    try:
-        return datetime.fromtimestamp(float(image_id.split("_")[1]), tz=timezone.utc)
-    except:
+    ts = expiration_ts(image_id)
+    if ts is None:
         return None
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
 
 
 def is_expired(image_id: str) -> bool:
     """
     Check whether entry is expired (based on timestamp encoded in the image_id)
+    Expiration is checked with 1 second granularity, so that results for repeated requests can be cached.
     """
 
-    ts = expiration(image_id)
-    now = datetime.now(timezone.utc)
-    if ts is None:
-        log.debug("Invalid cache entry ID: %s", image_id)
-        return True
-    log.debug("entry: %s (expiration ts: %s)", image_id, ts.isoformat())
-    return ts < now
+    return _expired_at(image_id, int(time()))
+
+
+@lru_cache(maxsize=4096)
+def _expired_at(image_id: str, now: int) -> bool:
+    ts = expiration_ts(image_id)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("entry: %s (expiration ts: %s)", image_id, "<invalid>" if ts is None else ts)
+    return ts is None or ts < now
 
 
 async def run_cache_pruning(c: ObjectCache, period: int):
     log.info("Scheduling periodic cache pruning (period: %d)", period)
     while True:
         await asyncio.sleep(period)
-        c.prune(is_expired)
+        # removing files (and syncing directories) is blocking
+        await asyncio.get_running_loop().run_in_executor(None, c.evict_expired)
 
 
 @app.post("/requests", response_model=ImageId, responses={400: {"model": ErrorResponse}})
-async def create_request(request: RequestData, background_tasks: BackgroundTasks):
+async def create_request(request: RequestData, background_tasks: BackgroundTasks, http_request: Request):
     """
     Generate unique image Id and if matching entry is not present
     in the cache schedule request to Kentik API
@@ -218,52 +292,72 @@ async def create_request(request: RequestData, background_tasks: BackgroundTasks
             },
             status_code=400,
         )
-    iid = make_image_id(request.api_query, request.ttl)
-    log.info("request: id: %s ttl: %d", iid, request.ttl)
-    r = cache.create_entry(iid, CacheEntryType.REQUEST, json.dumps(jsonable_encoder(request.api_query)))
-    if r == CreationStatus.EXISTING:
-        log.info("Entry %s already exists", iid)
+    try:
+        if int(http_request.headers.get("content-length", 0)) > _LARGE_QUERY_SIZE:
+            # Do not block the event loop while serializing and hashing large queries
+            iid, payload = await asyncio.get_running_loop().run_in_executor(
+                None, make_image_id, request.api_query, request.ttl
+            )
+        else:
+            iid, payload = make_image_id(request.api_query, request.ttl)
+    except orjson.JSONEncodeError as e:
+        # e.g. integers outside of 64-bit range
+        return JSONResponse(
+            content={
+                "loc": jsonable_encoder(request),
+                "msg": f"Invalid 'api_query': {e}",
+                "type": "invalid request",
+            },
+            status_code=400,
+        )
+    if iid in _waiters or cache.contains(iid):
+        r = CreationStatus.EXISTING
     else:
-        log.info("New Entry %s", iid)
+        # register the waiter first, so that concurrent requests for the same id do not create the entry again
+        ev = _waiters[iid] = asyncio.Event()
+        r = CreationStatus.EXISTING
+        try:
+            # writing the entry is blocking (the file is synced to disk)
+            r = await asyncio.get_running_loop().run_in_executor(
+                None, cache.create_entry, iid, CacheEntryType.REQUEST, payload
+            )
+        finally:
+            if _waiters.get(iid) is ev and r != CreationStatus.CREATED:
+                del _waiters[iid]
+                ev.set()
+    log.info("request: id: %s ttl: %d (%s entry)", iid, request.ttl, r.value)
+    if r == CreationStatus.CREATED:
         background_tasks.add_task(fetch_image, iid, request.api_query)
     return {"id": iid}
 
 
-@app.get(
-    "/image/{image_id}",
-    responses={
-        200: {"content": {"image/png": {}, "application/pdf": {}}},
-        422: {"model": ErrorResponse},
-        404: {"model": ErrorResponse},
-        408: {"model": ErrorResponse},
-        500: {"model": ErrorResponse},
-    },
-)
-def get_image(image_id: str):
+def entry_response(image_id: str, entry: CacheEntry):
     """
-    Retrieve cached image.
+    Return response for GET image request based on the cache entry
     """
 
-    log.info("GET image %s", image_id)
-    if is_expired(image_id):
-        log.info("GET %s: entry is expired", image_id)
-        return JSONResponse(
-            content={"loc": image_id, "msg": "Image not found", "type": "error"},
-            status_code=404,
-        )
-    cache.wait_for(image_id)
-    entry = cache.get_entry(image_id)
-    if entry is None:
-        return JSONResponse(
-            content={"loc": image_id, "msg": "Image not found", "type": "error"},
-            status_code=404,
-        )
     if entry.status == EntryStatus.ACTIVE:
         if entry.type == CacheEntryType.IMAGE:
-            img = pickle.loads(entry.data)
-            return Response(content=img.image_data, media_type=img_type_to_media(img.image_type))
+            info = unpack_image_info(entry.data)
+            if info is None:
+                log.error("GET %s: unsupported image entry format", image_id)
+                return JSONResponse(
+                    content={"loc": image_id, "msg": "Image not found", "type": "error"},
+                    status_code=404,
+                )
+            blob = cache.blob_path(image_id)
+            try:
+                st = os.stat(blob)
+            except FileNotFoundError:
+                # the blob was evicted meanwhile or lost
+                log.error("GET %s: image data not found", image_id)
+                return JSONResponse(
+                    content={"loc": image_id, "msg": "Image not found", "type": "error"},
+                    status_code=404,
+                )
+            return FileResponse(path=blob, stat_result=st, media_type=img_type_to_media(info[0]))
         if entry.type == CacheEntryType.ERROR_MSG:
-            d = json.loads(entry.data.decode())
+            d = orjson.loads(entry.data)
             return JSONResponse(
                 content={"loc": image_id, "msg": d["msgs"], "type": "Kentik API error"},
                 status_code=d["status_code"],
@@ -290,6 +384,48 @@ def get_image(image_id: str):
         )
 
 
+@app.get(
+    "/image/{image_id}",
+    responses={
+        200: {"content": {"image/png": {}, "application/pdf": {}}},
+        422: {"model": ErrorResponse},
+        404: {"model": ErrorResponse},
+        408: {"model": ErrorResponse},
+        500: {"model": ErrorResponse},
+    },
+)
+async def get_image(image_id: str):
+    """
+    Retrieve cached image.
+    """
+
+    log.info("GET image %s", image_id)
+    if is_expired(image_id):
+        log.info("GET %s: entry is expired", image_id)
+        return JSONResponse(
+            content={"loc": image_id, "msg": "Image not found", "type": "error"},
+            status_code=404,
+        )
+    ev = _waiters.get(image_id)
+    if ev is not None:
+        log.debug("GET %s: waiting for entry", image_id)
+        try:
+            await asyncio.wait_for(ev.wait(), timeout=settings.entry_wait_timeout)
+        except asyncio.TimeoutError:
+            log.error("GET %s: timeout waiting for entry", image_id)
+    entry = cache.get_hot_entry(image_id)
+    if entry is None:
+        # reading the entry file is blocking
+        entry = await asyncio.get_running_loop().run_in_executor(None, cache.get_entry, image_id)
+    if entry is None:
+        return JSONResponse(
+            content={"loc": image_id, "msg": "Image not found", "type": "error"},
+            status_code=404,
+        )
+    with entry:
+        return entry_response(image_id, entry)
+
+
 def entry_info(entry: CacheEntry) -> CacheEntryInfo:
     """Return CacheEntryInfo instance for given CacheEntry"""
     exp = expiration(entry.uid)
@@ -298,7 +434,9 @@ def entry_info(entry: CacheEntry) -> CacheEntryInfo:
         ts = "<invalid>"
     else:
         ts = f"{exp.isoformat()} (remaining: {exp - now})"
-    return CacheEntryInfo(id=entry.uid, type=entry.type.value, size=len(entry.data), expiration=ts)
+    info = unpack_image_info(entry.data) if entry.type == CacheEntryType.IMAGE else None
+    size = entry.size if info is None else info[1]
+    return CacheEntryInfo(id=entry.uid, type=entry.type.value, size=size, expiration=ts)
 
 
 @app.get("/info", response_model=CacheInfo)
@@ -324,11 +462,14 @@ async def get_favicon():
 @app.on_event("startup")
 async def startup_event():
     log.info("Startup cache pruning")
+    # full sweep of the file-system, also removes expired files which are not indexed
     cache.prune(is_expired)
     log.info("Startup cache pruning complete")
     # Restart requests for all remaining pending entries
     for e in cache.pending_entries:
         log.info("Restarting pending entry: %s", e.uid)
-        fetch_image(e.uid, json.loads(e.data.decode()))
+        _waiters[e.uid] = asyncio.Event()
+        with e:
+            asyncio.create_task(fetch_image(e.uid, orjson.loads(e.data)))
     # Start periodic cache pruning
     asyncio.create_task(run_cache_pruning(cache, settings.cache_maintenance_period))
@@ -1,12 +1,21 @@
 import logging
+import mmap
+import os
 from enum import Enum
 from pathlib import Path
-from typing import IO, Any, Optional
+from typing import IO, List, Optional, Union
 
 from .types import EntryStatus
 
 log = logging.getLogger("CacheEntry")
 
+# Size of the initial read of the entry file. Smaller entries are read completely on construction.
+_INITIAL_READ_SIZE = 64 * 1024
+# Size of the initial read of header-only entries (enough for the longest header line)
+_HEADER_READ_SIZE = 64
+# os.fdatasync is not available on all platforms
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
 
 class CacheEntryType(Enum):
     REQUEST = "api_request"
@@ -15,86 +24,172 @@ class CacheEntryType(Enum):
     INVALID = "invalid"
 
 
+# Entry types keyed by header line identifying them in the entry file
+_HEADER_MAP = {t.value.encode(): t for t in CacheEntryType}
+# Encoded header lines keyed by entry type
+_HEADER_BYTES = {t: f"{t.value}\n".encode() for t in CacheEntryType}
+
+
+def write_atomically(path: Union[str, Path], chunks: List[bytes], tmp_dir: Union[str, Path]) -> int:
+    """
+    Write chunks of data into a temporary file in 'tmp_dir' using a single vectored write, sync the file data
+    to disk and atomically replace 'path' with it. 'tmp_dir' must be on the same file-system as 'path', but must not
+    be the directory containing it (the temporary file has the same name as 'path').
+    Return number of bytes written.
+    """
+
+    tmp = os.path.join(tmp_dir, os.path.basename(path))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        n = os.writev(fd, chunks)
+        size = sum(len(c) for c in chunks)
+        if n < size:
+            # finish short write
+            rest = memoryview(b"".join(chunks))[n:]
+            while rest:
+                rest = rest[os.write(fd, rest) :]
+        _fdatasync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    return size
+
+
 class CacheEntry:
     """
     Class representing entries in the ObjectCache.
     Objects of this class are constructed and returned in the ObjectCache.get_entry method.
     CacheEntry stores type of data it contains in the first line of the content.
     The 'data' method returns stored data without the line identifying type.
+    The entry file is read in a single read on construction and the handle passed to the constructor is closed
+    immediately. Data of entries larger than the initial read are memory-mapped from the entry file on first access
+    and returned as a memoryview. Entries can be used as context managers, which release the mapping on exit.
+    Entries constructed with 'header_only' read only (about) the line identifying type and get the size from the file
+    metadata, which is cheaper when data are not needed (e.g. for listing). The handle should be unbuffered then.
     """
 
     def __init__(
         self,
         status=EntryStatus.PENDING,
         handle: Optional[IO] = None,
-        path: Optional[Path] = None,
+        path: Optional[Union[str, Path]] = None,
+        header_only: bool = False,
     ) -> None:
         self.status = status
-        self._handle = handle
-        if self._handle:
+        if handle:
             if path is not None:
-                log.error("Cache entry: %s path (%s) ignored", self._handle.name, path)
-            self._path = Path(self._handle.name)
+                log.error("Cache entry: %s path (%s) ignored", handle.name, path)
+            self._path: str = handle.name
         elif path is not None:
-            self._path = path
+            self._path = os.fspath(path)
         else:
             raise RuntimeError("Cache entry with no path and handle")
         self._type = CacheEntryType.INVALID
-        self._data: bytes = bytes(0)
-        if self._handle is None:
-            return
-        try:
-            header = self._handle.readline().strip().decode()
-            if header == CacheEntryType.REQUEST.value:
-                self._type = CacheEntryType.REQUEST
-            if header == CacheEntryType.ERROR_MSG.value:
-                self._type = CacheEntryType.ERROR_MSG
-            if header == CacheEntryType.IMAGE.value:
-                self._type = CacheEntryType.IMAGE
-        except IOError:
+        self._data: Optional[Union[bytes, memoryview]] = None
+        self._mm: Optional[mmap.mmap] = None
+        self._header_size = 0
+        self._size = 0
+        if handle is None:
+            self._data = bytes(0)
             return
-        self._data = self._handle.read()
-
-    def __del__(self):
-        if self._handle:
-            self._handle.close()
+        with handle:
+            try:
+                read_size = _HEADER_READ_SIZE if header_only else _INITIAL_READ_SIZE
+                buf = handle.read(read_size)
+                complete = len(buf) < read_size
+                if not complete:
+                    file_size = os.fstat(handle.fileno()).st_size
+            except IOError:
+                self._data = bytes(0)
+                return
+        nl = buf.find(b"\n")
+        self._header_size = nl + 1 if nl >= 0 else len(buf)
+        self._type = _HEADER_MAP.get(buf[: self._header_size].strip(), CacheEntryType.INVALID)
+        if complete:
+            self._data = buf[self._header_size :]
+            self._size = len(self._data)
+        else:
+            self._size = file_size - self._header_size
+
+    @classmethod
+    def from_data(
+        cls, status: EntryStatus, path: Union[str, Path], entry_type: CacheEntryType, data: bytes
+    ) -> "CacheEntry":
+        """Construct entry of known type and data without accessing the entry file"""
+        entry = cls(status, path=path)
+        entry._type = entry_type
+        entry._header_size = len(_HEADER_BYTES[entry_type])
+        entry._data = data
+        entry._size = len(data)
+        return entry
 
     @property
     def uid(self):
-        return self._path.name
+        return os.path.basename(self._path)
 
     @property
     def type(self) -> CacheEntryType:
         return self._type
 
     @property
-    def data(self) -> bytes:
+    def data(self) -> Union[bytes, memoryview]:
+        if self._data is None:
+            # the mapping remains valid after the file is closed and is released with the last reference to the view
+            with open(self._path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = memoryview(self._mm)[self._header_size :]
         return self._data
 
+    def close(self) -> None:
+        """
+        Release memory mapping of the entry data, if any. Views of the data returned before must not be used.
+        If parts of the data are still referenced elsewhere, the mapping is released with the last reference.
+        """
+        if self._mm is not None:
+            mm, self._mm = self._mm, None
+            data, self._data = self._data, None
+            try:
+                if isinstance(data, memoryview):
+                    data.release()
+                mm.close()
+            except BufferError:
+                # exported views of the mapping exist
+                pass
+
+    def __enter__(self) -> "CacheEntry":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def size(self) -> int:
+        """Size of the data (without the line identifying type), obtained without reading the data"""
+        return self._size
+
     @property
     def path(self) -> Path:
-        return self._path
-
-    def rename(self, name: Path) -> None:
-        """Rename the file representing the entry to new name and re-open it"""
-
-        if self._handle is None:
-            raise RuntimeError(f"Attempt to rename null handle to {name}")
-        log.debug("Renaming %s to %s", self._handle.name, name)
-        self._path.rename(name)
-        self._handle.close()
-        self._handle = Path(name).open("rb")
-        self._path = Path(self._handle.name)
-
-    def write(self, entry_type: CacheEntryType, data: Any) -> None:
-        """Write data of specified type into the file representing the entry"""
-
-        with self.path.open("wb") as f:
-            self._type = entry_type
-            f.write(bytes(f"{self._type.value}\n".encode()))
-            if type(data) == str:
-                n = f.write(bytes(data.encode()))
-            else:
-                n = f.write(data)
-            f.close()
-            log.debug("entry: %s, type: %s stored %d  bytes", f.name, self._type.name, n)
+        return Path(self._path)
+
+    def rename(self, name: Union[str, Path]) -> None:
+        """Atomically rename the file representing the entry to new name (replacing existing file, if any)"""
+
+        log.debug("Renaming %s to %s", self._path, name)
+        name = os.fspath(name)
+        os.replace(self._path, name)
+        self._path = name
+
+    def write(self, entry_type: CacheEntryType, data: bytes, tmp_dir: Union[str, Path]) -> None:
+        """
+        Atomically write data of specified type into the file representing the entry.
+        Data are written to a temporary file in 'tmp_dir', which then replaces the entry file. 'tmp_dir' must be
+        on the same file-system as the entry, but must not be the directory containing it.
+        """
+
+        self._type = entry_type
+        header = _HEADER_BYTES[entry_type]
+        n = write_atomically(self._path, [header, data], tmp_dir)
+        self._header_size = len(header)
+        self._size = n - self._header_size
+        self._data = None
+        log.debug("entry: %s, type: %s stored %d  bytes", self._path, self._type.name, n - len(header))
@@ -1,108 +1,198 @@
+import heapq
 import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from threading import Event
-from typing import Any, Callable, Dict, Optional
+from time import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-from .cache_entry import CacheEntry, CacheEntryType
+from .cache_entry import CacheEntry, CacheEntryType, write_atomically
 from .types import ActivationStatus, CreationStatus, EntryStatus
 
 log = logging.getLogger("file_cache")
 
+# Minimum number of files removed in one batch for which removal is spread over multiple threads
+_PARALLEL_UNLINK_MIN = 64
+# Maximum data size of active entries kept in memory by get_entry
+_HOT_ENTRY_MAX_SIZE = 4096
+
+
+def _fsync_dir(path: Union[str, Path]) -> None:
+    """Sync directory to disk, so that file renames and removals in it are durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _unlink(path: str) -> bool:
+    """Remove file, ignore files that do not exist. Return True if the file was removed"""
+    try:
+        os.unlink(path)
+        log.info("removing %s", path)
+        return True
+    except FileNotFoundError:
+        return False
+
 
 class ObjectCache:
     """
     Class implementing simple object cache.
 
     Objects are stored in files in local file-system.
-    Location of the cache data is defined by the 'base_dir' passed to the constructor. 2 sub-directories are
-    created in 'base_dir': 'pending' and 'active'.
+    Location of the cache data is defined by the 'base_dir' passed to the constructor. 4 sub-directories are
+    created in 'base_dir': 'pending', 'active', 'data' and 'tmp'.
     Entries in the cache (returned asCacheEntry objects) can be in 2 states:
     - CacheEntryStatus.PENDING: located in 'pending' directory
     - CacheEntryStatus.ACTIVE: located in 'active' directory
     On activation, files are atomically moved from pending to active.
+    Ids and paths (as strings) of entries in both states are indexed in memory, so that lookups, counts, listing
+    and eviction of entries do not need to scan the directories. The index is loaded on construction (the only scan
+    needed during normal operation) and can be re-synchronized with the file-system by 'prune'.
+    Active entries can have an associated blob (raw data without entry header) stored in the 'data' directory,
+    which allows to serve it directly from the file.
+    Files are written to 'tmp' sub-directory first and atomically moved in place when complete.
+    Methods can be called from multiple threads. Updates of the in-memory index are serialized by a lock,
+    file-system operations are performed without holding it.
 
     The cache does not parse or use content of cached data.
+    Expiration time of entries (in seconds since epoch) is derived from entry ids by the 'expiration' function
+    passed to the constructor. The function returns None for ids which are not valid.
+    Large batches of expired files are removed by up to 'unlink_workers' threads.
+    Type and data of recently accessed small active entries (which never change) are kept in a bounded in-memory
+    LRU, so that repeated lookups of the same entry do not read the entry file.
     """
 
-    def __init__(self, base_dir: Path, entry_wait_timeout: int) -> None:
+    def __init__(self, base_dir: Path, expiration: Callable[[str], Optional[float]], unlink_workers: int = 8) -> None:
         if not base_dir.is_dir():
             raise RuntimeError(f"Invalid cache base directory {base_dir}: not a directory")
         d = base_dir.resolve()
         self._active_dir = base_dir.joinpath("active")
         self._pending_dir = base_dir.joinpath("pending")
+        self._data_dir = base_dir.joinpath("data")
+        self._tmp_dir = base_dir.joinpath("tmp")
         self._active_dir.mkdir(exist_ok=True)
         self._pending_dir.mkdir(exist_ok=True)
-        self._events: Dict[str, Event] = dict()
-        self._entry_wait_timeout = entry_wait_timeout
-        log.debug("New ObjectCache: base_dir: %s", d)
-        log.debug(
-            "active: %d entries, pending: %d entries",
-            self.active_count,
-            self.pending_count,
-        )
-
-    def wait_for(self, entry_id: str) -> None:
-        """
-        Wait for entry to become active
-        Execution of the calling thread blocks until the entry becomes active or until timeout
-        If the event object does not exist, the method returns immediately
-        """
-        try:
-            log.debug("Waiting for id: %s", entry_id)
-            self._events[entry_id].wait(self._entry_wait_timeout)
-            log.debug("Entry id: %s is active", entry_id)
-        except KeyError:
-            log.error("No event for id: %s", entry_id)
+        self._data_dir.mkdir(exist_ok=True)
+        self._tmp_dir.mkdir(exist_ok=True)
+        # entry ids never contain path separators, so entry paths are built by plain string concatenation
+        self._active_prefix = os.fspath(self._active_dir) + os.sep
+        self._pending_prefix = os.fspath(self._pending_dir) + os.sep
+        self._data_prefix = os.fspath(self._data_dir) + os.sep
+        with os.scandir(self._tmp_dir) as it:
+            for e in it:
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                log.info("removing incomplete file %s", e.path)
+                os.unlink(e.path)
+        self._expiration = expiration
+        self._unlink_workers = unlink_workers
+        self._lock = threading.Lock()
+        # entry id -> (entry type, data) of recently accessed active entries in LRU order
+        self._hot: "OrderedDict[str, Tuple[CacheEntryType, bytes]]" = OrderedDict()
+        self._hot_max = 256
+        with os.scandir(self._active_dir) as it:
+            self._active: Dict[str, str] = {e.name: e.path for e in it if e.is_file(follow_symlinks=False)}
+        with os.scandir(self._pending_dir) as it:
+            self._pending: Dict[str, str] = {e.name: e.path for e in it if e.is_file(follow_symlinks=False)}
+        # min-heap of (expiration time, entry id) tuples used by evict_expired
+        self._expiry_heap: List[Tuple[float, str]] = [
+            (self._expiry_time(eid), eid) for eid in chain(self._active, self._pending)
+        ]
+        heapq.heapify(self._expiry_heap)
+        with os.scandir(self._data_dir) as it:
+            for e in it:
+                if e.name not in self._active and e.is_file(follow_symlinks=False):
+                    log.info("removing orphaned blob %s", e.path)
+                    os.unlink(e.path)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("New ObjectCache: base_dir: %s", d)
+            log.debug("active: %d entries, pending: %d entries", self.active_count, self.pending_count)
 
     def get_entry(self, entry_id: str) -> Optional[CacheEntry]:
         """
         Locate file matching entry_id if found return CacheEntry object, otherwise None.
         If matching file is found in the 'pending' directory returned CacheEntry has PENDING status.
         If found in 'active' directory, returned CacheEntry has ACTIVE status.
-        Return CacheEntry holds opened handle to the file which is closed when the entry is destroyed.
+        Returned CacheEntry does not hold the file open, its data are read from the file on first access.
         """
         log.debug("get: %s", entry_id)
         try:
-            p = self._active_dir.joinpath(entry_id)
-            handle = p.open("rb")
-            log.debug("Found active entry: %s", p)
-            return CacheEntry(handle=handle, status=EntryStatus.ACTIVE)
+            p = self._active.get(entry_id)
+            if p is not None:
+                hot = self.get_hot_entry(entry_id)
+                if hot is not None:
+                    return hot
+                handle = open(p, "rb")
+                log.debug("Found active entry: %s", p)
+                entry = CacheEntry(handle=handle, status=EntryStatus.ACTIVE)
+                if entry.size <= _HOT_ENTRY_MAX_SIZE:
+                    with self._lock:
+                        # the entry could have been evicted meanwhile
+                        if entry_id in self._active:
+                            self._hot[entry_id] = (entry.type, bytes(entry.data))
+                            if len(self._hot) > self._hot_max:
+                                self._hot.popitem(last=False)
+                return entry
+            p = self._pending.get(entry_id)
+            if p is not None:
+                handle = open(p, "rb")
+                log.debug("Found pending entry: %s", p)
+                return CacheEntry(handle=handle, status=EntryStatus.PENDING)
         except FileNotFoundError:
-            pass
-        try:
-            p = self._pending_dir.joinpath(entry_id)
-            handle = p.open("rb")
-            log.debug("Found pending entry: %s", p)
-            return CacheEntry(handle=handle, status=EntryStatus.PENDING)
-        except FileNotFoundError:
-            pass
+            log.error("Indexed entry %s is missing in the file-system", entry_id)
         log.debug("entry not found: %s", entry_id)
         return None
 
-    def create_entry(self, entry_id: str, entry_type: CacheEntryType, data: Any) -> CreationStatus:
+    def get_hot_entry(self, entry_id: str) -> Optional[CacheEntry]:
+        """
+        Return active entry if it is kept in memory, otherwise None. Unlike get_entry, this never accesses files.
+        """
+        with self._lock:
+            hot = self._hot.get(entry_id)
+            if hot is None:
+                return None
+            self._hot.move_to_end(entry_id)
+            p = self._active[entry_id]
+        return CacheEntry.from_data(EntryStatus.ACTIVE, p, *hot)
+
+    def contains(self, entry_id: str) -> bool:
         """
-        Attempt to create new cache entry.
+        Return True if entry with entry_id exists (in either state). Unlike get_entry, the entry file is not read.
+        """
+        return entry_id in self._active or entry_id in self._pending
+
+    def create_entry(self, entry_id: str, entry_type: CacheEntryType, data: Union[bytes, str]) -> CreationStatus:
+        """
+        Attempt to create new cache entry. Data passed as str are stored UTF-8 encoded.
         If it already exists return CreationStatus.EXISTING,
         otherwise write provided data to the entry and return CreationStatus.CREATED
         """
         log.debug("create: %s", entry_id)
-        entry = self.get_entry(entry_id)
-        if entry is not None:
-            log.debug(
-                "Found existing entry: %s (status: %s, type: %s)",
-                entry_id,
-                entry.status.value,
-                entry.type.value,
-            )
+        if self.contains(entry_id):
+            log.debug("Found existing entry: %s", entry_id)
             return CreationStatus.EXISTING
         else:
-            self._events[entry_id] = Event()
-            CacheEntry(EntryStatus.PENDING, path=self._pending_dir.joinpath(entry_id)).write(entry_type, data)
+            if isinstance(data, str):
+                data = data.encode()
+            p = self._pending_prefix + entry_id
+            CacheEntry(EntryStatus.PENDING, path=p).write(entry_type, data, self._tmp_dir)
+            with self._lock:
+                self._pending[entry_id] = p
+                heapq.heappush(self._expiry_heap, (self._expiry_time(entry_id), entry_id))
             return CreationStatus.CREATED
 
-    def activate_entry(self, entry_id: str, entry_type: CacheEntryType, data: Any) -> ActivationStatus:
+    def activate_entry(
+        self, entry_id: str, entry_type: CacheEntryType, data: Union[bytes, str], blob: Optional[bytes] = None
+    ) -> ActivationStatus:
         """
         Move specified entry from pending to active directory and write provided data to it.
+        If 'blob' is provided, it is stored in the 'data' directory before the entry becomes active.
         If entry does not exist, return ActivationStatus.FAILED.
         If entry exists and is not in pending state, it remains unmodified and ActivationStatus.FAILED is returned.
         """
@@ -114,58 +204,144 @@ class ObjectCache:
             log.error("Cannot active %s entry %s", entry.status.value, entry_id)
             return ActivationStatus.FAILED
         else:
-            entry.write(entry_type, data)
-            entry.rename(self._active_dir.joinpath(entry_id))
-            self._events[entry_id].set()
+            if blob is not None:
+                n = write_atomically(self.blob_path(entry_id), [blob], self._tmp_dir)
+                # the blob must be durable before the entry referring to it becomes active
+                _fsync_dir(self._data_dir)
+                log.debug("entry: %s stored %d bytes blob", entry_id, n)
+            if isinstance(data, str):
+                data = data.encode()
+            entry.write(entry_type, data, self._tmp_dir)
+            p = self._active_prefix + entry_id
+            entry.rename(p)
+            # commit the rename in both directories
+            _fsync_dir(self._pending_dir)
+            _fsync_dir(self._active_dir)
+            with self._lock:
+                evicted = self._pending.pop(entry_id, None) is None
+                if not evicted:
+                    self._hot.pop(entry_id, None)
+                    self._active[entry_id] = p
+            if evicted:
+                log.info("Entry %s expired during activation", entry_id)
+                _unlink(p)
+                if blob is not None:
+                    _unlink(self.blob_path(entry_id))
+                return ActivationStatus.FAILED
             return ActivationStatus.SUCCESS
 
     def prune(self, is_expired: Callable[[str], bool]):
         """
-        Method used for periodic pruning of the cache.
+        Method used for full pruning of the cache (walks all entries in the file-system).
         Provided function 'is_expired' is called to determine whether an entry needs to be evicted.
-        Expiration logic relies solely on entry ids.
+        Expiration logic relies solely on entry ids, so results of 'is_expired' are memoized during the call.
+        The entry index and the expiration heap used by evict_expired are rebuilt from remaining entries.
+        Must not be called concurrently with other methods modifying the cache.
         """
         log.debug("pruning cache")
-        to_remove = []
-        for e in self._pending_dir.iterdir():
-            eid = e.name
-            log.debug("pending entry: %s", eid)
-            if is_expired(eid):
-                log.debug("expired: %s", eid)
-                to_remove.append(e)
-        for e in self._active_dir.iterdir():
-            eid = e.name
-            log.debug("active entry: %s", eid)
-            if is_expired(eid):
-                log.debug("expired: %s", eid)
-                to_remove.append(e)
-        for e in to_remove:
-            log.info("removing %s", e)
-            try:
-                del self._events[e.name]
-            except KeyError as exc:
-                log.debug("Event was missing for %s", str(exc))
-            e.unlink()
-        log.debug(
-            "cache pruning complete: active: %d, pending: %d",
-            self.active_count,
-            self.pending_count,
-        )
+        # the same id is usually present in more than one directory (e.g. active entry and its blob)
+        is_expired = lru_cache(maxsize=None)(is_expired)
+        expired: List[str] = []
+        self._pending = self._prune_dir(self._pending_dir, is_expired, expired)
+        self._active = self._prune_dir(self._active_dir, is_expired, expired)
+        self._prune_dir(self._data_dir, is_expired, expired)
+        self._remove_files(expired)
+        heap = [(self._expiry_time(eid), eid) for eid in chain(self._active, self._pending)]
+        heapq.heapify(heap)
+        with self._lock:
+            self._hot = OrderedDict((eid, v) for eid, v in self._hot.items() if eid in self._active)
+            self._expiry_heap = heap
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("cache pruning complete: active: %d, pending: %d", self.active_count, self.pending_count)
+
+    @staticmethod
+    def _prune_dir(directory: Path, is_expired: Callable[[str], bool], expired: List[str]) -> Dict[str, str]:
+        """
+        Scan the directory in a single pass and append paths of expired files to 'expired'.
+        Return index of remaining files.
+        """
+        remaining: Dict[str, str] = dict()
+        debug = log.isEnabledFor(logging.DEBUG)
+        with os.scandir(directory) as it:
+            for e in it:
+                # skip anything that is not a regular file (type is known from the directory listing)
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                if is_expired(e.name):
+                    expired.append(e.path)
+                else:
+                    if debug:
+                        log.debug("keeping %s", e.path)
+                    remaining[e.name] = e.path
+        return remaining
+
+    def evict_expired(self) -> None:
+        """
+        Method used for periodic pruning of the cache.
+        Removes indexed entries in expiration order until the first entry that is not expired.
+        """
+        log.debug("evicting expired entries")
+        now = time()
+        expired: List[str] = []
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < now:
+                _, eid = heapq.heappop(self._expiry_heap)
+                p = self._pending.pop(eid, None)
+                if p is not None:
+                    expired.append(p)
+                p = self._active.pop(eid, None)
+                if p is not None:
+                    self._hot.pop(eid, None)
+                    expired.extend((p, self.blob_path(eid)))
+        self._remove_files(expired)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("eviction complete: active: %d, pending: %d", self.active_count, self.pending_count)
+
+    def _remove_files(self, paths: List[str]) -> None:
+        """
+        Remove files. Large batches are removed by multiple threads, so that unlink calls overlap.
+        Directories in which files were removed are synced once after the whole batch.
+        """
+        if not paths:
+            return
+        if len(paths) < _PARALLEL_UNLINK_MIN or self._unlink_workers < 2:
+            removed = [_unlink(p) for p in paths]
+        else:
+            with ThreadPoolExecutor(max_workers=self._unlink_workers, thread_name_prefix="unlink") as ex:
+                removed = list(ex.map(_unlink, paths))
+        for d in {os.path.dirname(p) for p, r in zip(paths, removed) if r}:
+            _fsync_dir(d)
+
+    def blob_path(self, entry_id: str) -> str:
+        """Return path of the file storing blob associated with the entry"""
+        return self._data_prefix + entry_id
+
+    def _expiry_time(self, entry_id: str) -> float:
+        """Return expiration time of the entry. Entries with invalid ids are treated as already expired"""
+        ts = self._expiration(entry_id)
+        return 0.0 if ts is None else ts
 
     @property
-    def active_count(self):
-        return len([e for e in self._active_dir.iterdir()])
+    def active_count(self) -> int:
+        return len(self._active)
 
     @property
-    def pending_count(self):
-        return len([e for e in self._pending_dir.iterdir()])
+    def pending_count(self) -> int:
+        return len(self._pending)
 
     @property
-    def active_entries(self):
-        for f in self._active_dir.iterdir():
-            yield CacheEntry(handle=f.open("rb"), status=EntryStatus.ACTIVE)
+    def active_entries(self) -> Iterator[CacheEntry]:
+        return self._entries(self._active, EntryStatus.ACTIVE)
 
     @property
-    def pending_entries(self):
-        for f in self._pending_dir.iterdir():
-            yield CacheEntry(handle=f.open("rb"), status=EntryStatus.PENDING)
+    def pending_entries(self) -> Iterator[CacheEntry]:
+        return self._entries(self._pending, EntryStatus.PENDING)
+
+    @staticmethod
+    def _entries(index: Dict[str, str], status: EntryStatus) -> Iterator[CacheEntry]:
+        """Yield CacheEntry objects for indexed entries. Only headers are read, entry data are read when accessed."""
+        for p in list(index.values()):
+            try:
+                yield CacheEntry(handle=open(p, "rb", buffering=0), status=status, header_only=True)
+            except FileNotFoundError:
+                log.error("Indexed entry %s is missing in the file-system", p)
@@ -48,7 +48,7 @@ setup(
     long_description="Application for caching of images rendered by the _/query/topxchart_ Kentik API method.",
     url="https://github.com/kentik/kentik_image_cache",
     license="Apache-2.0",
-    install_requires=["fastapi>=0.65.1", "kentik-api>=0.2.0"],
+    install_requires=["blake3>=0.2.0", "fastapi>=0.65.1", "kentik-api>=0.2.0", "orjson>=3.5.2"],
     setup_requires=["pytest-runner", "setuptools_scm", "wheel"],
     tests_require=["httpretty", "pytest", "mypy", "typer"],
     packages=find_packages(),